@@ -0,0 +1,47 @@
+from translate import compose_srt, parse_srt
+
+
+def test_parse_multiline_entries():
+    parsed = parse_srt(
+        "1\n00:02:17,440 --> 00:02:20,375\nSenator, we're making\nour final approach into Coruscant.\n\n"
+        "2\n00:02:20,476 --> 00:02:22,501\nVery good, Lieutenant.\n"
+    )
+    assert [entry.index for entry in parsed.entries] == [1, 2]
+    assert parsed.entries[0].start == "00:02:17,440"
+    assert parsed.entries[0].end == "00:02:20,375"
+    assert parsed.sentences == ["Senator, we're making", "our final approach into Coruscant.", "Very good, Lieutenant."]
+    assert parsed.lines_per_entry == [2, 1]
+
+
+def test_parse_empty_entry_text():
+    parsed = parse_srt("1\n00:00:01,000 --> 00:00:02,000\n\n2\n00:00:03,000 --> 00:00:04,000\nBye\n")
+    assert [entry.index for entry in parsed.entries] == [1, 2]
+    assert [entry.text for entry in parsed.entries] == ["", "Bye"]
+
+
+def test_parse_whitespace_separator_line():
+    parsed = parse_srt("1\n00:00:01,000 --> 00:00:02,000\nHello\n \t\n2\n00:00:03,000 --> 00:00:04,000\nBye\n")
+    assert [entry.text for entry in parsed.entries] == ["Hello", "Bye"]
+
+
+def test_parse_bom_and_crlf():
+    parsed = parse_srt("\ufeff1\r\n00:00:01,000 --> 00:00:02,000\r\nHello\r\n\r\n2\r\n00:00:03,000 --> 00:00:04,000\r\nBye\r\n")
+    assert [entry.index for entry in parsed.entries] == [1, 2]
+    assert parsed.sentences == ["Hello", "Bye"]
+
+
+def test_compose_round_trip():
+    content = (
+        "1\n00:00:01,000 --> 00:00:02,000\nHello there\nGeneral\n\n"
+        "2\n00:00:03,000 --> 00:00:04,000\n\n\n"
+        "3\n00:00:05,000 --> 00:00:06,000\nBye\n"
+    )
+    parsed = parse_srt(content)
+    assert compose_srt(parsed, parsed.sentences) == content
+    assert parse_srt(compose_srt(parsed, parsed.sentences)) == parsed
+
+
+def test_compose_keeps_lines_with_their_entry():
+    parsed = parse_srt("1\n00:00:01,000 --> 00:00:02,000\nA\nB\n\n2\n00:00:03,000 --> 00:00:04,000\nC\n")
+    composed = compose_srt(parsed, ["a", "b", "c"])
+    assert [entry.text for entry in parse_srt(composed).entries] == ["a\nb", "c"]
@@ -0,0 +1,210 @@
+import asyncio
+from collections import OrderedDict
+from types import SimpleNamespace
+
+import httpx
+import openai
+import orjson
+import pytest
+import tiktoken
+from aiolimiter import AsyncLimiter
+from tenacity import wait_none
+
+import translate
+
+
+class FakeStream:
+    def __init__(self, content):
+        self.content = content
+
+    async def __aiter__(self):
+        for i in range(0, len(self.content), 7):
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=self.content[i:i + 7]))])
+
+    async def close(self):
+        pass
+
+
+class FakeCompletions:
+    """Translates each line to "T:<line>", streaming numbered lines or answering batches as JSON."""
+
+    def __init__(self):
+        self.calls = []
+        self.models = []
+        self.error = None
+        self.batch_reply = None
+
+    async def create(self, model, messages, stream=False):
+        self.calls.append(messages[-1]["content"])
+        self.models.append(model)
+        if self.error is not None:
+            raise self.error
+        user_content = messages[-1]["content"]
+        if stream:
+            return FakeStream("\n".join(line.replace(") ", ") T:", 1) for line in user_content.split("\n")))
+        if self.batch_reply is not None:
+            return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=self.batch_reply))])
+        chunks = []
+        for line in user_content.split("\n"):
+            if line.startswith("Chunk "):
+                chunks.append([])
+            else:
+                chunks[-1].append("T:" + line.split(") ", 1)[1])
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=orjson.dumps({"chunks": chunks}).decode()))])
+
+
+class FakeDeepL:
+    def __init__(self):
+        self.calls = []
+
+    async def post(self, url, data):
+        self.calls.append(data["text"])
+        text = "\n".join("D:" + line for line in data["text"].split("\n"))
+        return SimpleNamespace(content=orjson.dumps({"translations": [{"text": text}]}))
+
+
+@pytest.fixture
+def service(monkeypatch):
+    # Byte-level encoding built offline, with the one special token the service must treat as text
+    tokenizer = tiktoken.Encoding(
+        name="test_bytes",
+        pat_str=r"\S+|\s+",
+        mergeable_ranks={bytes([i]): i for i in range(256)},
+        special_tokens={"<|endoftext|>": 256},
+    )
+    monkeypatch.setattr(translate, "get_tokenizer", lambda: tokenizer)
+    translate.count_base_message_tokens.cache_clear()
+    translate.count_batch_system_prompt_tokens.cache_clear()
+
+    monkeypatch.setattr(translate, "translation_cache", OrderedDict())
+    monkeypatch.setattr(translate, "openai_semaphore", asyncio.Semaphore(8))
+    monkeypatch.setattr(translate, "deepl_semaphore", asyncio.Semaphore(32))
+    monkeypatch.setattr(translate, "openai_rate_limiter", AsyncLimiter(max_rate=1000, time_period=1))
+    monkeypatch.setattr(translate, "deepl_rate_limiter", AsyncLimiter(max_rate=1000, time_period=1))
+    monkeypatch.setattr(translate.call_openai_throttled.retry, "wait", wait_none())
+
+    completions = FakeCompletions()
+    deepl = FakeDeepL()
+    monkeypatch.setattr(translate.app.state, "openai_client", SimpleNamespace(chat=SimpleNamespace(completions=completions)), raising=False)
+    monkeypatch.setattr(translate.app.state, "deepl_http", deepl, raising=False)
+    return SimpleNamespace(openai=completions, deepl=deepl)
+
+
+def make_srt(texts):
+    return "".join(f"{i}\n00:00:{i:02d},000 --> 00:00:{i:02d},500\n{text}\n\n" for i, text in enumerate(texts, 1))
+
+
+def entry_texts(srt_content):
+    return [entry.text for entry in translate.parse_srt(srt_content).entries]
+
+
+def translate_srt(srt_content):
+    request = translate.TranslationRequest(srt_content=srt_content, source_language="en", target_language="tr")
+    return asyncio.run(translate.translate_subtitle(request))
+
+
+def test_special_token_text_is_translated(service):
+    response = translate_srt("1\n00:00:01,000 --> 00:00:02,000\nHe typed <|endoftext|> into the chat\n")
+    assert response.status == "success"
+    assert "T:He typed <|endoftext|> into the chat" in response.translated_srt_content
+    assert service.deepl.calls == []
+
+
+def test_model_is_chosen_from_batching_token_counts(service, monkeypatch):
+    class BatchOnlyTokenizer:
+        # User turns must be sized from the batching counts, never tokenized again one by one
+        def __init__(self, tokenizer):
+            self.tokenizer = tokenizer
+
+        def encode_batch(self, *args, **kwargs):
+            return self.tokenizer.encode_batch(*args, **kwargs)
+
+        def encode(self, *args, **kwargs):
+            raise AssertionError("user turn tokenized again")
+
+    monkeypatch.setattr(translate, "get_tokenizer", lambda tokenizer=BatchOnlyTokenizer(translate.get_tokenizer()): tokenizer)
+    monkeypatch.setattr(translate, "count_batch_system_prompt_tokens", lambda *languages: 100)
+    long_line = "word " * 1000
+    response = translate_srt(
+        "1\n00:00:01,000 --> 00:00:02,000\nShort line\nAnother short line\nA third one\n\n"
+        f"2\n00:00:03,000 --> 00:00:04,000\n{long_line}\n"
+    )
+    assert response.status == "success"
+    assert service.openai.models == [translate.openai_model, translate.openai_long_model]
+
+
+def test_openai_errors_on_a_batch_go_straight_to_deepl(service):
+    service.openai.error = openai.RateLimitError(
+        "rate limited",
+        response=httpx.Response(429, request=httpx.Request("POST", "https://api.openai.com/v1/chat/completions")),
+        body=None,
+    )
+    texts = [f"Line {i}" for i in range(1, 25)]
+    response = translate_srt(make_srt(texts))
+    assert response.status == "success"
+    assert entry_texts(response.translated_srt_content) == [f"D:{text}" for text in texts]
+    # One batch, retried to exhaustion, then each of its eight chunks once on DeepL and never again on OpenAI
+    assert len(service.openai.calls) == translate.call_openai_throttled.retry.stop.max_attempt_number
+    assert len(service.deepl.calls) == 8
+
+
+@pytest.mark.parametrize("batch_reply", [
+    "Sorry, I cannot help with that.",
+    '{"chunks": "T:Line 1"}',
+    '{"chunks": [["T:Line 1", "T:Line 2", "T:Line 3"]]}',
+    '{"translations": []}',
+])
+def test_unusable_batch_reply_falls_back_to_three_line_chunks(service, batch_reply):
+    service.openai.batch_reply = batch_reply
+    texts = [f"Line {i}" for i in range(1, 8)]
+    response = translate_srt(make_srt(texts))
+    assert response.status == "success"
+    assert entry_texts(response.translated_srt_content) == [f"T:{text}" for text in texts]
+    assert service.openai.calls[1:] == ["1) Line 1\n2) Line 2\n3) Line 3", "1) Line 4\n2) Line 5\n3) Line 6", "1) Line 7"]
+    assert service.deepl.calls == []
+
+
+@pytest.mark.parametrize("batch_reply", [None, "not JSON"], ids=["batched", "per_chunk"])
+def test_cues_and_dialogue_land_back_in_their_entries(service, batch_reply):
+    service.openai.batch_reply = batch_reply
+    texts = [
+        "Hello there\nHow are you",
+        "[Music]",
+        "I am fine\nThanks",
+        "(laughter)",
+        "[Music]",
+        "Bye",
+    ]
+    expected = [
+        "T:Hello there\nT:How are you",
+        "T:[Music]",
+        "T:I am fine\nT:Thanks",
+        "T:(laughter)",
+        "T:[Music]",
+        "T:Bye",
+    ]
+    srt_content = make_srt(texts)
+
+    response = translate_srt(srt_content)
+    assert response.status == "success"
+    assert entry_texts(response.translated_srt_content) == expected
+    # Dialogue windows skip the cues, ending in a partial window, and each distinct cue is sent once
+    assert service.openai.calls[0] == (
+        "Chunk 1:\n1) Hello there\n2) How are you\n3) I am fine\n"
+        "Chunk 2:\n1) Thanks\n2) Bye\n"
+        "Chunk 3:\n1) [Music]\n2) (laughter)"
+    )
+    if batch_reply is not None:
+        assert service.openai.calls[1:] == [
+            "1) Hello there\n2) How are you\n3) I am fine",
+            "1) Thanks\n2) Bye",
+            "1) [Music]\n2) (laughter)",
+        ]
+    openai_calls = len(service.openai.calls)
+
+    # A second request is served entirely from the cache and comes back the same
+    response = translate_srt(srt_content)
+    assert response.status == "success"
+    assert entry_texts(response.translated_srt_content) == expected
+    assert len(service.openai.calls) == openai_calls
+    assert service.deepl.calls == []
@@ -1,27 +1,49 @@
 import os
+import re
 import time
 import math
 import asyncio
 import logging
-import traceback
-import requests
-import pysrt
-import spacy
+from collections import OrderedDict
+from contextlib import aclosing, asynccontextmanager
+from dataclasses import dataclass
+from functools import lru_cache
+from itertools import islice
+import httpx
+import orjson
 import openai
+import tiktoken
 from typing import Optional
 from pydantic import BaseModel
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import ORJSONResponse
 from aiolimiter import AsyncLimiter
 from rich.logging import RichHandler
 from rich.console import Console
-from tenacity import retry, stop_after_attempt
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential_jitter
+
+# Shared HTTP clients live on app.state for the whole process lifetime
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # max_retries=0 leaves retrying to our own tenacity policy
+    app.state.openai_client = openai.AsyncOpenAI(api_key=openai_api_key, max_retries=0)
+    app.state.deepl_http = httpx.AsyncClient(
+        base_url='https://api-free.deepl.com/v2',
+        headers={'Authorization': 'DeepL-Auth-Key ' + deepl_api_key},
+        timeout=30.0,
+        http2=True,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=100, keepalive_expiry=30.0)
+    )
+    yield
+    await app.state.openai_client.close()
+    await app.state.deepl_http.aclose()
 
 # FastAPI Instance
-app = FastAPI()
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 
 # Set up logging with Rich library
 logging.basicConfig(
-    level=logging.DEBUG,
+    level=os.getenv('LOG_LEVEL', 'INFO').upper(),
     format="%(message)s",
     handlers=[RichHandler(rich_tracebacks=True)]
 )
@@ -41,144 +63,438 @@ class TranslationResponse(BaseModel):
     status: str
     error_message: Optional[str] = None
 
+# Internal subtitle container; the data comes straight from our own regex, so it skips pydantic validation
+@dataclass(slots=True, frozen=True)
+class SubtitleEntry:
+    index: int
+    start: str
+    end: str
+    text: str
+
+@dataclass(slots=True)
+class ParsedSubtitle:
+    entries: list
+    sentences: list
+    lines_per_entry: list
+
 # OpenAI API Key
-openai.api_key = os.getenv('OPENAI_API_KEY', 'xxx')
+openai_api_key = os.getenv('OPENAI_API_KEY', 'xxx')
 
 # DeepL API Key
 deepl_api_key = os.getenv('DEEPL_API_KEY', 'xxx')
 
-# Rate Limiter
+# Rate Limiters, one per upstream service
 max_calls = int(os.getenv('MAX_CALLS', 20))
-rate_limiter = AsyncLimiter(max_rate=max_calls, time_period=1)  # Adjustable rate limits
-
-# NLP model for sentence tokenization
-nlp = spacy.load("en_core_web_sm")
-
-async def translate_with_openai(chunk, source_language, target_language):
-    response = openai.ChatCompletion.create(
-        model="gpt-3.5-turbo-16k",
-        messages=[
-            {"role": "system", "content": f"You are an AI model specializing in subtitle translation. Your task is to translate three lines of text from a source language to a target language, while retaining the original tone and context. Make sentences short and clear for the target audience, who are young people favoring concise sentences. You can slightly deviate from the original text without altering its meaning too much. Do not modify any timestamps, personal information, or disrupt the original format.\r\n\r\nHere's the input format:\r\n\r\n```\r\n1) first string to translate\r\n2) second string to translate\r\n3) third string to translate\r\n```\r\n\r\nAnd the expected output:\r\n\r\n```\r\n1) translated first string\r\n2) translated second string\r\n3) translated third string\r\n```\r\n\r\nWhile translating, keep in mind:\r\n\r\n- Source language for the translation: {source_language}\r\n- Target language for the translation: {target_language}\r\n\r\nFrom now on, the 'user' will provide the text directly in three lines. You should return your translation preserving its format. If the user\u2019s input isn't three lines, return at least 3 lines that can be even a new line without content but the output must be having three lines. Use plain Turkish that everyone can understand in translation. Please try to understand the context between three lines and respect to flow of subtitle by deeply understanding context before translating."},
-            {"role": "user", "content": f"1) I think you guys know me and obviously the prime minister, but if you guys could introduce yourselves and say a bit about you and, you've done both done amazing things, so please don't be shy.\r\n2) Greg Brockman from OpenAI: Sure thing.\r\n3) So I'm Greg Brockman."},
-            {"role": "assistant", "content": f"1) San\u0131r\u0131m beni ve tabii ki ba\u015Fbakan\u0131 tan\u0131yorsunuz. Ama siz kendinizi tan\u0131tabilir ve hakk\u0131n\u0131zda biraz bilgi verebilir misiniz? \u0130kiniz de harika \u015Feyler ba\u015Fard\u0131n\u0131z, l\u00FCtfen \u00E7ekinmeden konu\u015Fun.\r\n2) Greg Brockman \/ OpenAI'dan: Tabii ki!\r\n3) Evet, ben Greg Brockman. "},
-            {"role": "user", "content": f"1) Greg Brockman from OpenAI: did it.\r\n2) We literally had an intern in 20, 2016.\r\n3) So our very first summer who we had this conversation about."},
-            {"role": "assistant", "content": f"1) OpenAI'dan Greg Brockman: biz yapm\u0131\u015Ft\u0131k!\r\n2) 2016'da tam 20 ya\u015F\u0131nda bi tane harbi stajyerimiz vard\u0131\r\n3) Bu muhabbeti yapt\u0131\u011F\u0131m\u0131zda OpenAI'daki ilk yaz aylar\u0131m\u0131zd\u0131"},
-            {"role": "user", "content": f"1) The Max's book takes you to the existential question of whether, you\r\n2) project basically machine intelligence or human intelligence into the cosmos,\r\n3) human intelligence turned into machine intelligence into the cosmos and so on."},
-            {"role": "assistant", "content": f"1) Max'\u0131n kitab\u0131, bize varolu\u015Fumuzla ilgili \u00E7ok ilgin\u00E7 bir soru soruyor.\r\n2) Biz evrene robot zekas\u0131 m\u0131, yoksa insan zekas\u0131 m\u0131 b\u0131rakaca\u011F\u0131z? \r\n3) Yoksa insan zekas\u0131 bundan sonra tamamen robot zakas\u0131 m\u0131 demek olacak?"},   
-            {"role": "user", "content": "\n".join(chunk)},
-        ]
+openai_rate_limiter = AsyncLimiter(max_rate=max_calls, time_period=1)  # Adjustable rate limits
+deepl_max_calls = int(os.getenv('DEEPL_MAX_CALLS', 20))
+deepl_rate_limiter = AsyncLimiter(max_rate=deepl_max_calls, time_period=1)
+
+# Concurrency caps, one per upstream service; DeepL tolerates far more parallel requests than OpenAI
+openai_semaphore = asyncio.Semaphore(int(os.getenv('OPENAI_CONCURRENCY', 8)))
+deepl_semaphore = asyncio.Semaphore(int(os.getenv('DEEPL_CONCURRENCY', 32)))
+
+# Transient OpenAI errors are retried with backoff before a chunk falls back to DeepL
+openai_retry = retry(
+    stop=stop_after_attempt(3),
+    wait=wait_exponential_jitter(multiplier=2, max=10),
+    retry=retry_if_exception_type((
+        openai.RateLimitError,
+        openai.APIConnectionError,
+        openai.InternalServerError
+    )),
+    reraise=True
+)
+
+# Upper bound on batch tasks in flight per request, so huge files do not hold every prompt in memory at once
+max_inflight_batches = int(os.getenv('MAX_INFLIGHT_BATCHES', 16))
+
+# In-memory LRU cache of OpenAI translations per context window, shared across requests
+translation_cache_size = int(os.getenv('TRANSLATION_CACHE_SIZE', 10000))
+translation_cache = OrderedDict()
+
+# Token budget for the source text sent to OpenAI in a single request
+batch_max_tokens = int(os.getenv('BATCH_MAX_TOKENS', 500))
+
+# Tokenizer used to size batches and prompts, loaded once on first use rather than at import,
+# since tiktoken may have to download its encoding
+@lru_cache(maxsize=None)
+def get_tokenizer():
+    return tiktoken.encoding_for_model("gpt-3.5-turbo-16k")
+
+# Prompts that fit the smaller model's context go to it; longer ones go to the long-context model
+openai_model = os.getenv('OPENAI_MODEL', 'gpt-3.5-turbo')
+openai_model_max_tokens = int(os.getenv('OPENAI_MODEL_MAX_TOKENS', 4096))
+openai_long_model = os.getenv('OPENAI_LONG_MODEL', 'gpt-3.5-turbo-16k')
+
+# SRT entry: index, start and end timestamps, then the (possibly empty) text block, which
+# runs until the first line that is empty or holds only whitespace
+SRT_ENTRY_RE = re.compile(r"(?m)^[ \t]*(\d+)[ \t]*\n[ \t]*(\d{2}:\d{2}:\d{2}[,\.]\d{3})[ \t]*-->[ \t]*(\d{2}:\d{2}:\d{2}[,\.]\d{3})[^\n]*((?:\n(?![ \t]*$)[^\n]*)*)")
+
+# Numbered line in an OpenAI reply, e.g. "1) text", "2. text" or "3: text"
+RESPONSE_LINE_RE = re.compile(r"^[ \t]*\d+[ \t]*[).:][ \t]*(.*?)[ \t\r]*$", re.MULTILINE)
+
+# Index prefix the model may keep on a batched line, and the prefixes we number chunk lines with
+INDEX_PREFIX_RE = re.compile(r"^\s*\d+\)\s*")
+INDEX_PREFIXES = ("1) ", "2) ", "3) ")
+
+# Stock cue that needs no surrounding context, e.g. "[Music]" or "(laughter)"
+CUE_RE = re.compile(r"^[ \t]*(?:\[[^\[\]]*\]|\([^()]*\))[ \t]*$")
+
+# Few-shot examples sent ahead of every three-line chunk
+FEW_SHOT_MESSAGES = (
+    {"role": "user", "content": f"1) I think you guys know me and obviously the prime minister, but if you guys could introduce yourselves and say a bit about you and, you've done both done amazing things, so please don't be shy.\r\n2) Greg Brockman from OpenAI: Sure thing.\r\n3) So I'm Greg Brockman."},
+    {"role": "assistant", "content": f"1) San\u0131r\u0131m beni ve tabii ki ba\u015Fbakan\u0131 tan\u0131yorsunuz. Ama siz kendinizi tan\u0131tabilir ve hakk\u0131n\u0131zda biraz bilgi verebilir misiniz? \u0130kiniz de harika \u015Feyler ba\u015Fard\u0131n\u0131z, l\u00FCtfen \u00E7ekinmeden konu\u015Fun.\r\n2) Greg Brockman \/ OpenAI'dan: Tabii ki!\r\n3) Evet, ben Greg Brockman. "},
+    {"role": "user", "content": f"1) Greg Brockman from OpenAI: did it.\r\n2) We literally had an intern in 20, 2016.\r\n3) So our very first summer who we had this conversation about."},
+    {"role": "assistant", "content": f"1) OpenAI'dan Greg Brockman: biz yapm\u0131\u015Ft\u0131k!\r\n2) 2016'da tam 20 ya\u015F\u0131nda bi tane harbi stajyerimiz vard\u0131\r\n3) Bu muhabbeti yapt\u0131\u011F\u0131m\u0131zda OpenAI'daki ilk yaz aylar\u0131m\u0131zd\u0131"},
+    {"role": "user", "content": f"1) The Max's book takes you to the existential question of whether, you\r\n2) project basically machine intelligence or human intelligence into the cosmos,\r\n3) human intelligence turned into machine intelligence into the cosmos and so on."},
+    {"role": "assistant", "content": f"1) Max'\u0131n kitab\u0131, bize varolu\u015Fumuzla ilgili \u00E7ok ilgin\u00E7 bir soru soruyor.\r\n2) Biz evrene robot zekas\u0131 m\u0131, yoksa insan zekas\u0131 m\u0131 b\u0131rakaca\u011F\u0131z? \r\n3) Yoksa insan zekas\u0131 bundan sonra tamamen robot zakas\u0131 m\u0131 demek olacak?"},
+)
+
+def parse_srt(content):
+    entries, sentences, lines_per_entry = [], [], []
+    content = content.removeprefix('\ufeff').replace('\r\n', '\n')
+    for m in SRT_ENTRY_RE.finditer(content):
+        index, start, end, text = m.group(1, 2, 3, 4)
+        text = text[1:]  # Drop the newline that ends the timestamp line
+        lines = text.split('\n')
+        entries.append(SubtitleEntry(index=int(index), start=start, end=end, text=text))
+        sentences.extend(lines)
+        lines_per_entry.append(len(lines))
+    return ParsedSubtitle(entries=entries, sentences=sentences, lines_per_entry=lines_per_entry)
+
+def compose_srt(parsed, translated_sentences):
+    # Walk the entries with a running cursor so each one gets back as many lines as it had,
+    # writing every fragment into one flat list that is joined once at the end
+    parts = []
+    cursor = 0
+    for entry, n in zip(parsed.entries, parsed.lines_per_entry):
+        parts.extend((str(entry.index), '\n', entry.start, ' --> ', entry.end, '\n', '\n'.join(translated_sentences[cursor:cursor + n]), '\n\n'))
+        cursor += n
+    if parts:
+        parts[-1] = '\n'  # The last entry is not followed by a blank separator line
+    return ''.join(parts)
+
+def get_cached_translation(key):
+    translation = translation_cache.get(key)
+    if translation is not None:
+        translation_cache.move_to_end(key)
+    return translation
+
+def cache_translation(key, translation):
+    translation_cache[key] = translation
+    translation_cache.move_to_end(key)
+    if len(translation_cache) > translation_cache_size:
+        translation_cache.popitem(last=False)
+
+def create_token_budgeted_batches(chunks, max_tokens):
+    # Greedily pack consecutive chunks until the next one would exceed the budget.
+    # A batch always holds at least one full chunk so no line loses its context window.
+    # Each batch comes with its chunks' token counts, so the OpenAI calls can size their prompts without re-tokenizing.
+    # Tokenize every sentence in one multi-threaded call rather than one encode per sentence.
+    # Subtitle lines are user text, so special-token strings like "<|endoftext|>" count as plain text
+    token_counts = [
+        len(ids)
+        for ids in get_tokenizer().encode_batch([sentence for chunk in chunks for sentence in chunk], num_threads=8, disallowed_special=())
+    ]
+
+    batches = []
+    batch, batch_chunk_tokens, batch_tokens = [], [], 0
+    position = 0
+    for chunk in chunks:
+        chunk_tokens = sum(token_counts[position:position + len(chunk)])
+        position += len(chunk)
+        if batch and batch_tokens + chunk_tokens > max_tokens:
+            batches.append((batch, batch_chunk_tokens))
+            batch, batch_chunk_tokens, batch_tokens = [], [], 0
+        batch.append(chunk)
+        batch_chunk_tokens.append(chunk_tokens)
+        batch_tokens += chunk_tokens
+    if batch:
+        batches.append((batch, batch_chunk_tokens))
+    return batches
+
+@lru_cache(maxsize=256)
+def build_system_prompt(source_language, target_language):
+    return f"You are an AI model specializing in subtitle translation. Your task is to translate three lines of text from a source language to a target language, while retaining the original tone and context. Make sentences short and clear for the target audience, who are young people favoring concise sentences. You can slightly deviate from the original text without altering its meaning too much. Do not modify any timestamps, personal information, or disrupt the original format.\r\n\r\nHere's the input format:\r\n\r\n```\r\n1) first string to translate\r\n2) second string to translate\r\n3) third string to translate\r\n```\r\n\r\nAnd the expected output:\r\n\r\n```\r\n1) translated first string\r\n2) translated second string\r\n3) translated third string\r\n```\r\n\r\nWhile translating, keep in mind:\r\n\r\n- Source language for the translation: {source_language}\r\n- Target language for the translation: {target_language}\r\n\r\nFrom now on, the 'user' will provide the text directly in three lines. You should return your translation preserving its format. If the user\u2019s input isn't three lines, return at least 3 lines that can be even a new line without content but the output must be having three lines. Use plain Turkish that everyone can understand in translation. Please try to understand the context between three lines and respect to flow of subtitle by deeply understanding context before translating."
+
+@lru_cache(maxsize=256)
+def build_batch_system_prompt(source_language, target_language):
+    return f"You are an AI model specializing in subtitle translation. Your task is to translate several chunks of up to three lines of text from a source language to a target language, while retaining the original tone and context. Make sentences short and clear for the target audience, who are young people favoring concise sentences. You can slightly deviate from the original text without altering its meaning too much. Do not modify any timestamps, personal information, or disrupt the original format.\r\n\r\nHere's the input format:\r\n\r\n```\r\nChunk 1:\r\n1) first string to translate\r\n2) second string to translate\r\n3) third string to translate\r\nChunk 2:\r\n1) fourth string to translate\r\n2) fifth string to translate\r\n3) sixth string to translate\r\n```\r\n\r\nAnd the expected output, a JSON object with one array of translated lines per chunk, without the line numbers:\r\n\r\n```\r\n{{\"chunks\": [[\"translated first string\", \"translated second string\", \"translated third string\"], [\"translated fourth string\", \"translated fifth string\", \"translated sixth string\"]]}}\r\n```\r\n\r\nWhile translating, keep in mind:\r\n\r\n- Source language for the translation: {source_language}\r\n- Target language for the translation: {target_language}\r\n\r\nReturn exactly one array per input chunk, in the same order, and exactly one translated line per input line. Respond with the JSON object only. Use plain language that everyone can understand in translation. Please try to understand the context between the chunks and respect to flow of subtitle by deeply understanding context before translating."
+
+@lru_cache(maxsize=256)
+def build_base_messages(source_language, target_language):
+    # System prompt plus few-shots, shared by every chunk of a language pair; a tuple so callers cannot mutate it
+    return ({"role": "system", "content": build_system_prompt(source_language, target_language)}, *FEW_SHOT_MESSAGES)
+
+# The fixed prompt prefix is the same for every request of a language pair, so count it once per pair.
+# The language names come from the request, so special-token strings in them count as plain text
+@lru_cache(maxsize=256)
+def count_base_message_tokens(source_language, target_language):
+    return sum(
+        len(get_tokenizer().encode(message["content"], disallowed_special=()))
+        for message in build_base_messages(source_language, target_language)
+    )
+
+@lru_cache(maxsize=256)
+def count_batch_system_prompt_tokens(source_language, target_language):
+    return len(get_tokenizer().encode(build_batch_system_prompt(source_language, target_language), disallowed_special=()))
+
+# Allowance for the line numbers and "Chunk k:" headers wrapped around each source line
+NUMBERING_TOKENS_PER_LINE = 4
+
+def choose_model(prefix_tokens, source_tokens, line_count):
+    # Source tokens are counted once while batching, so the user turn is sized without encoding it again.
+    # A translation is roughly as long as its source, so leave the same room again for the reply
+    prompt_tokens = prefix_tokens + source_tokens + NUMBERING_TOKENS_PER_LINE * line_count
+    return openai_model if 2 * prompt_tokens <= openai_model_max_tokens else openai_long_model
+
+async def stream_lines(response):
+    # Yield each complete line of a streamed chat completion as soon as its newline arrives
+    buffer = ""
+    try:
+        async for event in response:
+            if event.choices:
+                buffer += event.choices[0].delta.content or ''
+            *complete, buffer = buffer.split("\n")
+            for line in complete:
+                yield line
+        if buffer:
+            yield buffer
+    finally:
+        await response.close()
+
+async def translate_with_openai(client, chunk, source_tokens, source_language, target_language):
+    messages = [*build_base_messages(source_language, target_language), {"role": "user", "content": "\n".join(chunk)}]
+    response = await client.chat.completions.create(
+        model=choose_model(count_base_message_tokens(source_language, target_language), source_tokens, len(chunk)),
+        messages=messages,
+        stream=True
     )
-    response_lines = response['choices'][0]['message']['content'].split("\n", 2)
+
+    # Parse numbered lines as they stream in and stop reading once all three have arrived
+    response_lines, raw_lines = [], []
+    async with aclosing(stream_lines(response)) as lines:
+        async for line in lines:
+            raw_lines.append(line)
+            match = RESPONSE_LINE_RE.match(line)
+            if match:
+                response_lines.append(match.group(1))
+                if len(response_lines) == 3:
+                    break
+
+    # Only a reply with a numbered line for every input line is complete enough to cache
+    complete = len(response_lines) >= len(chunk)
+
+    # Fall back to the raw lines if the model did not number its reply
+    response_lines = response_lines or raw_lines[:3]
 
     # Ensure there are exactly three lines
-    while len(response_lines) < 3:
-        response_lines.append("")
+    response_lines += [""] * (3 - len(response_lines))
+
+    return response_lines, complete
+
+async def translate_batch_with_openai(client, chunks, source_tokens, source_language, target_language):
+    user_content = "\n".join(f"Chunk {c+1}:\n" + "\n".join(chunk) for c, chunk in enumerate(chunks))
+    messages = [
+        {"role": "system", "content": build_batch_system_prompt(source_language, target_language)},
+        {"role": "user", "content": user_content},
+    ]
+    response = await client.chat.completions.create(
+        model=choose_model(count_batch_system_prompt_tokens(source_language, target_language), source_tokens, sum(map(len, chunks))),
+        messages=messages
+    )
+    content = response.choices[0].message.content
+    translated_chunks = orjson.loads(content[content.find('{'):content.rfind('}') + 1])['chunks']
 
-    return response_lines
+    # The reply is only usable if it is a list of string lists lining up with the input chunk for chunk
+    if (
+        not isinstance(translated_chunks, list)
+        or len(translated_chunks) != len(chunks)
+        or any(not isinstance(t, list) or len(t) != len(c) or not all(isinstance(line, str) for line in t)
+               for t, c in zip(translated_chunks, chunks))
+    ):
+        raise ValueError(f"Expected {len(chunks)} chunks in batch reply, got a mismatched structure")
 
-def translate_with_deepl(chunk, target_language):
-    data = {'text': "\n".join(chunk), 'target_lang': target_language}
-    headers = {'Authorization': 'DeepL-Auth-Key ' + deepl_api_key}
-    response = requests.post('https://api-free.deepl.com/v2/translate', headers=headers, data=data)
-    return response.json()['translations'][0]['text'].split("\n")
+    return translated_chunks
 
-async def translate_chunk(chunk, source_language, target_language):
-    async with rate_limiter:
-        try:
-            # Prepend each sentence with its index
-            indexed_chunk = [f"{i+1}) {sentence}" for i, sentence in enumerate(chunk)]
+async def translate_with_deepl(http_client, chunk, target_language):
+    data = {'text': "\n".join(chunk), 'target_lang': target_language}
+    response = await http_client.post('/translate', data=data)
+    return orjson.loads(response.content)['translations'][0]['text'].split("\n")
+
+async def call_throttled(semaphore, limiter, translate, *args):
+    # Hold a service's permit only for that service's own call, so a chunk
+    # falling back to DeepL never keeps an OpenAI slot busy
+    async with semaphore, limiter:
+        return await translate(*args)
+
+@openai_retry
+async def call_openai_throttled(translate, *args):
+    # Retry around the throttle, not inside it: each attempt takes a fresh permit and
+    # limiter slot, and nothing is held during the backoff sleeps
+    return await call_throttled(openai_semaphore, openai_rate_limiter, translate, *args)
+
+async def translate_chunk(chunk, chunk_tokens, source_language, target_language):
+    try:
+        # Prepend each sentence with its index
+        indexed_chunk = [prefix + sentence for prefix, sentence in zip(INDEX_PREFIXES, chunk)]
 
-            log.debug(f"Translating chunk: {indexed_chunk}")  # Log the chunk
+        log.debug("Translating chunk: %r", indexed_chunk)  # Log the chunk
 
-            translated_chunk = await translate_with_openai(indexed_chunk, source_language, target_language)
+        translated_chunk, complete = await call_openai_throttled(translate_with_openai, app.state.openai_client, indexed_chunk, chunk_tokens, source_language, target_language)
 
-            # Ensure there are exactly three lines
-            while len(translated_chunk) < 3:
-                translated_chunk.append("")
+        log.debug("Translated chunk: %r", translated_chunk)  # Log the translated chunk
 
-            # Strip the index from each translated sentence
-            translated_chunk = [sentence.split(') ', 1)[1] if ') ' in sentence else sentence for sentence in translated_chunk]
+        # Keep padded or unnumbered replies out of the cache so the chunk is retried next time
+        if complete:
+            cache_translation((source_language, target_language, tuple(chunk)), translated_chunk)
 
-            log.debug(f"Translated chunk: {translated_chunk}")  # Log the translated chunk
+        return translated_chunk
+    except Exception as e:
+        log.error("Error with OpenAI API: %s. Switching to fallback service: DeepL", e)
 
-            return translated_chunk
-        except Exception as e:
-            log.error(f"Error with OpenAI API: {str(e)}. Switching to fallback service: DeepL")
+        return await translate_chunk_with_deepl(chunk, target_language)
 
-            # Do not prepend the index for DeepL
-            translated_chunk = translate_with_deepl(chunk, target_language)
+async def translate_chunk_with_deepl(chunk, target_language):
+    # Do not prepend the index for DeepL
+    translated_chunk = await call_throttled(deepl_semaphore, deepl_rate_limiter, translate_with_deepl, app.state.deepl_http, chunk, target_language)
 
-            # Ensure there are exactly three lines
-            while len(translated_chunk) < 3:
-                translated_chunk.append("Translation not available")
+    # Ensure there are exactly three lines
+    translated_chunk = translated_chunk[:3]
+    translated_chunk += ["Translation not available"] * (3 - len(translated_chunk))
 
-            log.debug(f"Translated chunk with DeepL: {translated_chunk}")  # Log the chunk translated with DeepL
+    log.debug("Translated chunk with DeepL: %r", translated_chunk)  # Log the chunk translated with DeepL
 
-            return translated_chunk
+    return translated_chunk
 
 
-@app.post("/subtitle-translate", response_model=TranslationResponse)
-async def translate_subtitle(request: TranslationRequest):
+async def translate_batch(chunks, chunk_tokens, source_language, target_language):
     try:
-        log.debug("Received translation request")  # Log the request
-        start_time = time.time()
-        subs = pysrt.from_string(request.srt_content, encoding='iso-8859-1')
-        combined_text = ' '.join([sub.text for sub in subs])
-        doc = nlp(combined_text)
-        sentences = [line for sub in subs for line in sub.text.split('\n')]
+        # Prepend each sentence with its index
+        indexed_chunks = [[prefix + sentence for prefix, sentence in zip(INDEX_PREFIXES, chunk)] for chunk in chunks]
+
+        log.debug("Translating batch of %d chunks", len(chunks))  # Log the batch
+
+        translated_chunks = await call_openai_throttled(translate_batch_with_openai, app.state.openai_client, indexed_chunks, sum(chunk_tokens), source_language, target_language)
+
+        # Strip the index from each translated sentence, in case the model kept it
+        translated_chunks = [[INDEX_PREFIX_RE.sub('', sentence, count=1) for sentence in chunk] for chunk in translated_chunks]
 
-        log.debug(f"Split sentences into {len(sentences)} chunks")  # Add debug log here
+        log.debug("Translated batch: %r", translated_chunks)  # Log the translated batch
 
-        # Create a list to hold all the tasks
-        tasks = []
-        for i in range(0, len(sentences), 3):
-            chunk = sentences[i : i+3]
-            # Create a task for each chunk and add it to the tasks list
-            tasks.append(asyncio.create_task(translate_chunk(chunk, request.source_language, request.target_language)))
+        for chunk, translated_chunk in zip(chunks, translated_chunks):
+            cache_translation((source_language, target_language, tuple(chunk)), translated_chunk)
 
-        # Gather all the tasks and run them in parallel
-        translated_sentences = await asyncio.gather(*tasks, return_exceptions=True)
+        return translated_chunks
+    except openai.APIError as e:
+        # OpenAI is still failing after its retries; going chunk by chunk would only hit it again, so use DeepL
+        log.error("Error with batched OpenAI translation: %s. Switching to fallback service: DeepL", e)
+        fallbacks = (translate_chunk_with_deepl(chunk, target_language) for chunk in chunks)
+    except (ValueError, orjson.JSONDecodeError, KeyError, TypeError) as e:
+        # The reply did not parse or did not line up with the input, so drop back to three-line chunks
+        log.error("Error with batched OpenAI translation: %s. Falling back to per-chunk translation", e)
+        fallbacks = (translate_chunk(chunk, tokens, source_language, target_language) for chunk, tokens in zip(chunks, chunk_tokens))
 
-        # Handle exceptions (i.e., failed translations)
-        for i, result in enumerate(translated_sentences):
-            if isinstance(result, Exception):
-                log.error(f"Failed to translate chunk #{i}: {result}")
-                translated_sentences[i] = ["..."] * 3  # Replace the failed translation with "..."
+    translated_chunks = await asyncio.gather(*fallbacks, return_exceptions=True)
+    for i, result in enumerate(translated_chunks):
+        if isinstance(result, Exception):
+            log.error("Failed to translate chunk: %s", result)
+            translated_chunks[i] = ["..."] * 3  # Replace the failed translation with "..."
 
-        # Flatten the list of translated sentences
-        translated_sentences = [sentence for chunk in translated_sentences for sentence in chunk]
+    return translated_chunks
 
-        if len(translated_sentences) != len(sentences):
+
+@app.post("/subtitle-translate", response_model=TranslationResponse)
+async def translate_subtitle(request: TranslationRequest):
+    try:
+        log.debug("Received translation request")  # Log the request
+        start_time = time.time()
+        # Parsing and composing are pure CPU work, so run them off the event loop
+        parsed = await asyncio.to_thread(parse_srt, request.srt_content)
+        sentences = parsed.sentences
+
+        log.debug("Split sentences into %d chunks", len(sentences))  # Add debug log here
+
+        # Pull stock cues out before windowing so each distinct cue is translated once, wherever it
+        # appears, and the dialogue around it still forms unbroken three-line context windows
+        is_cue = [bool(CUE_RE.match(sentence)) for sentence in sentences]
+        dialogue = [sentence for sentence, cue in zip(sentences, is_cue) if not cue]
+        cues = list(dict.fromkeys(sentence.strip() for sentence, cue in zip(sentences, is_cue) if cue))
+
+        # Split the dialogue into three-line context windows and the cues into chunks of three after them,
+        # then group those into batches
+        chunks = [dialogue[i : i+3] for i in range(0, len(dialogue), 3)]
+        dialogue_chunk_count = len(chunks)
+        chunks += [cues[i : i+3] for i in range(0, len(cues), 3)]
+
+        # Translate each distinct chunk once; only windows whose three lines match exactly share a translation
+        unique_chunks = {}
+        positions = [unique_chunks.setdefault(tuple(chunk), len(unique_chunks)) for chunk in chunks]
+        unique_chunks = list(unique_chunks)
+
+        # Serve context windows translated by earlier requests from the cache and only send the misses
+        translated_chunks = [get_cached_translation((request.source_language, request.target_language, chunk)) for chunk in unique_chunks]
+        missing = [i for i, translation in enumerate(translated_chunks) if translation is None]
+        log.debug("Translation cache served %d of %d chunks", len(unique_chunks) - len(missing), len(unique_chunks))
+        # Tokenizing the misses is CPU work too, so batch them off the event loop
+        batches = await asyncio.to_thread(create_token_budgeted_batches, [list(unique_chunks[i]) for i in missing], batch_max_tokens)
+
+        # Keep at most max_inflight_batches tasks alive, remembering which slot each result belongs in,
+        # and collect results into their slots as they complete, releasing each finished task right away
+        translated_batches = [None] * len(batches)
+        queued = enumerate(batches)
+        tasks = {}
+        while True:
+            for i, (batch, chunk_tokens) in islice(queued, max_inflight_batches - len(tasks)):
+                tasks[asyncio.create_task(translate_batch(batch, chunk_tokens, request.source_language, request.target_language))] = i
+            if not tasks:
+                break
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                i = tasks.pop(task)
+                try:
+                    translated_batches[i] = task.result()
+                except Exception as e:
+                    # Handle exceptions (i.e., failed translations)
+                    log.error("Failed to translate batch #%d: %s", i, e)
+                    translated_batches[i] = [["..."] * 3 for _ in batches[i][0]]  # Replace the failed translation with "..."
+
+        # Fill in the cache misses, then fan every chunk back out to each position it came from
+        for i, translation in zip(missing, (chunk for batch in translated_batches for chunk in batch)):
+            translated_chunks[i] = translation
+        translated_dialogue = [sentence for position in positions[:dialogue_chunk_count] for sentence in translated_chunks[position]]
+        translated_cues = {
+            cue: translation
+            for position in positions[dialogue_chunk_count:]
+            for cue, translation in zip(unique_chunks[position], translated_chunks[position])
+        }
+
+        if len(translated_dialogue) != len(dialogue):
             log.error("Mismatch in number of sentences in the translated text.")  # Log the mismatch
             # Handle mismatch situations by adding or removing lines as necessary
-            while len(translated_sentences) < len(sentences):
-                translated_sentences.append("...")
-            translated_sentences = translated_sentences[:len(sentences)]
-
-        for i, sub in enumerate(subs):
-            if i < len(translated_sentences):
-                sub.text = translated_sentences[i]
-            else:
-                sub.text = ""  # Or some placeholder text
-
-        translated_srt_content = '\n'.join([str(sub) for sub in subs])
-        log.debug(f"Translated SRT content: {translated_srt_content}")  # Log the translated SRT content
-        log.info(f"Translation completed in {time.time() - start_time} seconds.")
-
-        # Save state every 10 subtitles
-        if len(subs) % 10 == 0:
-            with open('state.txt', 'w') as f:
-                f.write(f"Current position: {len(subs)}\n")
-                f.write("Translated text so far:\n" + '\n'.join([str(sub) for sub in subs]))
-
-        return TranslationResponse(
+            while len(translated_dialogue) < len(dialogue):
+                translated_dialogue.append("...")
+            translated_dialogue = translated_dialogue[:len(dialogue)]
+
+        # Put each cue's translation back in its original place between the dialogue lines
+        translated_dialogue = iter(translated_dialogue)
+        translated_sentences = [
+            translated_cues.get(sentence.strip(), "...") if cue else next(translated_dialogue)
+            for sentence, cue in zip(sentences, is_cue)
+        ]
+
+        translated_srt_content = await asyncio.to_thread(compose_srt, parsed, translated_sentences)
+        log.debug("Translated SRT content: %s", translated_srt_content)  # Log the translated SRT content
+        log.info("Translation completed in %s seconds.", time.time() - start_time)
+
+        return TranslationResponse.model_construct(
             translated_srt_content=translated_srt_content,
             status="success"
         )
     except Exception as e:
-        log.error(f"An error occurred: {str(e)}")
-        log.debug(f"Exception details: {traceback.format_exc()}")
-        return TranslationResponse(
+        log.error("An error occurred: %s", e)
+        log.debug("Exception details:", exc_info=True)
+        return TranslationResponse.model_construct(
             translated_srt_content="",
             status="failure",
             error_message=str(e)